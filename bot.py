@@ -1,14 +1,17 @@
 import asyncio
+import contextlib
 import logging
-import json
+import logging.handlers
 import os
+import queue
 import secrets
 import time
-from datetime import datetime, timedelta
-from typing import Dict, Any, List
+from typing import Dict, Any, Awaitable, Callable, List, Optional, Set, Tuple
 
-from aiogram import Bot, Dispatcher, F, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command, StateFilter
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -17,11 +20,27 @@ from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton
 )
 from dotenv import load_dotenv
+import aiofiles
+import aiosqlite
 import httpx
+import orjson
+
+try:
+    import uvloop # Быстрый event loop на libuv (нет под Windows)
+except ImportError:
+    uvloop = None
 
 # --- КОНФИГУРАЦИЯ ---
 load_dotenv()
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Логи пишет отдельный поток, чтобы запись в stderr не блокировала event loop
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.handlers.QueueHandler(log_queue)]
+)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -30,71 +49,333 @@ CHAT_ID_1 = int(os.getenv("CHAT_ID_1", "0"))
 CHAT_ID_2 = int(os.getenv("CHAT_ID_2", "0"))
 TONAPI_KEY = os.getenv("TONAPI_KEY")
 WALLET_ADDRESS = os.getenv("WALLET_ADDRESS")
-DATA_FILE = "data.json"
+TONAPI_URL = "https://tonapi.io/v2"
+TON_TX_LIMIT = 100 # Сколько последних транзакций кошелька смотрим за проверку
+PENDING_TTL = 86400 # Через сутки неоплаченный счёт помечается истёкшим и больше не проверяется
+DB_FILE = "data.db"
+DATA_FILE = "data.json" # Старая JSON-база, импортируется в SQLite при первом запуске
+FLUSH_DELAY = 0.5 # Сек. ожидания перед записью, чтобы объединить пачку изменений
 
 # Лимиты ключей за нахождение в чатах (настраиваемо)
 KEYS_PER_CHAT = 3 
-
-bot = Bot(token=BOT_TOKEN)
+KEY_TTL = 30 * 86400 # Срок действия ключа, сек.
+KEYS_SWEEP_INTERVAL = 86400 # Раз в сутки чистим истёкшие ключи
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+MEMBERSHIP_TTL = 600 # Сколько секунд доверяем закэшированному статусу в чате
+
+# Пул соединений к Bot API (по умолчанию 100 — мало для всплесков нажатий)
+API_POOL_SIZE = 500
+API_TIMEOUT = 60
+
+# Внешние HTTP-запросы (TON API)
+HTTP_TIMEOUT = 10
+HTTP_MAX_CONNECTIONS = 50
+HTTP_MAX_KEEPALIVE = 10
+HTTP_RETRIES = 2
+
+# Лимиты Telegram на исходящие сообщения
+GLOBAL_RATE = 30 # сообщений в секунду на весь бот
+CHAT_RATE = 1 # сообщений в секунду в один чат
+
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(limit=API_POOL_SIZE, timeout=API_TIMEOUT))
 dp = Dispatcher(storage=MemoryStorage())
 
-# --- РАБОТА С ФАЙЛОМ (БАЗА ДАННЫХ) ---
-
-def load_data() -> Dict[str, Any]:
-    if not os.path.exists(DATA_FILE):
-        return {"users": {}, "pending": {}}
+# --- РАБОТА С БАЗОЙ ДАННЫХ (SQLite) ---
+
+class UserRec:
+    """Запись пользователя; __slots__ вместо dict заметно экономит память на больших базах"""
+    __slots__ = ("username", "manual_limit", "keys_used", "keys")
+
+    def __init__(self, username: Optional[str], manual_limit: Optional[int] = None,
+                 keys_used: int = 0, keys: Optional[List[Dict[str, Any]]] = None):
+        self.username = username
+        self.manual_limit = manual_limit # Если None, считается автоматически
+        self.keys_used = keys_used
+        self.keys = keys if keys is not None else []
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "UserRec":
+        return cls(data.get("username"), data.get("manual_limit"), data.get("keys_used", 0), data.get("keys"))
+
+# Вся база живёт в памяти: загружается один раз в main(), хендлеры меняют
+# словарь напрямую и помечают изменённые записи через mark_dirty(),
+# а в SQLite их построчно сбрасывает фоновая задача flusher().
+DATA: Dict[str, Any] = {"users": {}, "pending": {}}
+DATA_DIRTY = asyncio.Event()
+DIRTY_USERS: Set[str] = set()
+DIRTY_PENDING: Set[str] = set()
+
+DB: Optional[aiosqlite.Connection] = None
+DB_LOCK = asyncio.Lock()
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT,
+    manual_limit INTEGER,
+    keys_used INTEGER NOT NULL DEFAULT 0,
+    keys_json BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_username ON users(username);
+CREATE TABLE IF NOT EXISTS pending (
+    comment TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    amount REAL NOT NULL,
+    created_at REAL NOT NULL,
+    status TEXT NOT NULL
+);
+"""
+
+UPSERT_USER = """
+INSERT INTO users (id, username, manual_limit, keys_used, keys_json) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET
+    username = excluded.username,
+    manual_limit = excluded.manual_limit,
+    keys_used = excluded.keys_used,
+    keys_json = excluded.keys_json
+"""
+
+UPSERT_PENDING = """
+INSERT INTO pending (comment, user_id, amount, created_at, status) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(comment) DO UPDATE SET status = excluded.status
+"""
+
+async def init_db():
+    global DB
+    DB = await aiosqlite.connect(DB_FILE, isolation_level=None)
+    await DB.execute("PRAGMA journal_mode=WAL")
+    await DB.execute("PRAGMA synchronous=NORMAL")
+    await DB.executescript(DB_SCHEMA)
+
+async def load_json_data() -> Dict[str, Any]:
+    """Старый формат хранения (data.json), нужен только для переезда в SQLite"""
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
+        async with aiofiles.open(DATA_FILE, "rb") as f:
+            return orjson.loads(await f.read())
+    except (orjson.JSONDecodeError, FileNotFoundError):
         return {"users": {}, "pending": {}}
 
-def save_data(data: Dict[str, Any]):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+async def load_data() -> Dict[str, Any]:
+    data = {"users": {}, "pending": {}}
+    async with DB.execute("SELECT id, username, manual_limit, keys_used, keys_json FROM users") as cursor:
+        async for uid, username, manual_limit, keys_used, keys_json in cursor:
+            data["users"][uid] = UserRec(username, manual_limit, keys_used, orjson.loads(keys_json))
+    async with DB.execute("SELECT comment, user_id, amount, created_at, status FROM pending") as cursor:
+        async for comment, user_id, amount, created_at, status in cursor:
+            data["pending"][comment] = {
+                "user_id": user_id,
+                "amount": amount,
+                "created_at": created_at,
+                "status": status
+            }
+    return data
+
+async def save_data(user_ids: Set[str], comments: Set[str]):
+    """Записывает в SQLite только переданные записи одной транзакцией"""
+    # Снимок строк делаем до первого await, пока хендлеры не успели поменять данные
+    user_rows = []
+    for uid in user_ids:
+        user = DATA["users"][uid]
+        user_rows.append((uid, user.username, user.manual_limit, user.keys_used, orjson.dumps(user.keys)))
+    pending_rows = []
+    deleted = []
+    for comment in comments:
+        info = DATA["pending"].get(comment)
+        if info is None:
+            deleted.append((comment,))
+        else:
+            pending_rows.append((comment, info["user_id"], info["amount"], info["created_at"], info["status"]))
+
+    async with DB_LOCK:
+        # BEGIN внутри try: при отмене посреди него ROLLBACK всё равно встанет за ним в очередь
+        try:
+            await DB.execute("BEGIN")
+            await DB.executemany(UPSERT_USER, user_rows)
+            await DB.executemany(UPSERT_PENDING, pending_rows)
+            await DB.executemany("DELETE FROM pending WHERE comment = ?", deleted)
+            await DB.execute("COMMIT")
+        except BaseException:
+            # При отмене во время COMMIT он всё равно выполнится, и ROLLBACK
+            # упадёт с "no transaction is active" — эта ошибка не должна
+            # подменить исходное исключение (в т.ч. CancelledError)
+            if DB.in_transaction:
+                with contextlib.suppress(aiosqlite.Error):
+                    await DB.execute("ROLLBACK")
+            raise
+
+def mark_dirty(user_id: Optional[str] = None, comment: Optional[str] = None):
+    """Помечает запись изменённой, запись в базу сделает flusher()"""
+    if user_id is not None:
+        DIRTY_USERS.add(user_id)
+    if comment is not None:
+        DIRTY_PENDING.add(comment)
+    DATA_DIRTY.set()
+
+async def flush_dirty():
+    DATA_DIRTY.clear()
+    user_ids, comments = set(DIRTY_USERS), set(DIRTY_PENDING)
+    DIRTY_USERS.clear()
+    DIRTY_PENDING.clear()
+    try:
+        await save_data(user_ids, comments)
+    except BaseException:
+        # Вернём записи в очередь (в т.ч. при отмене задачи), попробуем в следующий раз
+        DIRTY_USERS.update(user_ids)
+        DIRTY_PENDING.update(comments)
+        DATA_DIRTY.set()
+        raise
+
+async def flusher():
+    """Фоновая запись изменений в базу с задержкой (debounce)"""
+    while True:
+        await DATA_DIRTY.wait()
+        await asyncio.sleep(FLUSH_DELAY)
+        try:
+            await flush_dirty()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка сохранения базы: {e}")
+
+# Обратный индекс username -> user_id для поиска в админке
+USERNAME_INDEX: Dict[str, str] = {}
+
+def build_username_index(data: Dict):
+    USERNAME_INDEX.clear()
+    for uid, user in data["users"].items():
+        if user.username:
+            USERNAME_INDEX[user.username] = uid
 
 def ensure_user(user_id: str, username: str, data: Dict):
     if user_id not in data["users"]:
-        data["users"][user_id] = {
-            "username": username,
-            "manual_limit": None, # Если None, считается автоматически
-            "keys_used": 0,
-            "keys": []
-        }
+        data["users"][user_id] = UserRec(username)
     else:
         # Обновляем юзернейм если изменился
-        data["users"][user_id]["username"] = username
+        old_username = data["users"][user_id].username
+        if old_username == username:
+            return
+        if old_username and USERNAME_INDEX.get(old_username) == user_id:
+            del USERNAME_INDEX[old_username]
+        data["users"][user_id].username = username
+    mark_dirty(user_id)
+    if username:
+        USERNAME_INDEX[username] = user_id
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
-async def calculate_limit(user_id: int, user_data: Dict) -> int:
+# Сильные ссылки на фоновые задачи, иначе GC может убить их на полпути
+BG_TASKS: Set[asyncio.Task] = set()
+
+def _on_task_done(task: asyncio.Task):
+    BG_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.warning(f"Фоновая задача {task.get_name()} упала: {task.exception()}")
+
+def spawn(coro) -> asyncio.Task:
+    """Запускает корутину в фоне, не дожидаясь результата"""
+    task = asyncio.create_task(coro)
+    BG_TASKS.add(task)
+    task.add_done_callback(_on_task_done)
+    return task
+
+# Кэш статусов в чатах: (chat_id, user_id) -> (время запроса, статус)
+MEMBERSHIP_CACHE: Dict[Tuple[int, int], Tuple[float, str]] = {}
+
+async def cached_status(chat_id: int, user_id: int, ttl: int = MEMBERSHIP_TTL) -> str:
+    """Статус пользователя в чате, get_chat_member дёргаем не чаще раза в ttl секунд"""
+    key = (chat_id, user_id)
+    now = time.time()
+    cached = MEMBERSHIP_CACHE.get(key)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+
+    member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+    MEMBERSHIP_CACHE[key] = (now, member.status)
+    return member.status
+
+# Чаты, где бот админ: только в них Telegram присылает chat_member апдейты
+ADMIN_CHATS: Set[int] = set()
+BOT_ADMIN_STATUSES = ('administrator', 'creator')
+
+# Участники, о вступлении которых бот узнал из chat_member за время работы.
+# В базу не пишем: выходы, случившиеся пока бот был выключен, теряются,
+# и сохранённый список мог бы навсегда оставить бонус ушедшим.
+MEMBERS: Dict[int, Set[int]] = {}
+
+def set_member(chat_id: int, user_id: int, is_member: bool):
+    """Обновляет локальный список участников чата (только по chat_member апдейтам)"""
+    if is_member:
+        MEMBERS.setdefault(chat_id, set()).add(user_id)
+    else:
+        MEMBERS.get(chat_id, set()).discard(user_id)
+
+def set_bot_admin(chat_id: int, is_admin: bool):
+    if is_admin:
+        ADMIN_CHATS.add(chat_id)
+    else:
+        # Без прав админа апдейты о выходах перестанут приходить
+        ADMIN_CHATS.discard(chat_id)
+        MEMBERS.pop(chat_id, None)
+
+async def is_chat_member(chat_id: int, user_id: int) -> bool:
+    """
+    В чатах, где бот админ, вступивших за время работы видно по chat_member
+    апдейтам, и это просто проверка по множеству. Остальных (и все чаты, где бот
+    не админ) проверяем через API с TTL-кэшем.
+    """
+    if chat_id in ADMIN_CHATS and user_id in MEMBERS.get(chat_id, ()):
+        return True
+    status = await cached_status(chat_id, user_id)
+    return status in MEMBER_STATUSES
+
+async def bootstrap_members():
+    """Определяет чаты, где бот админ, и сразу заносит их администраторов"""
+    for chat_id in (CHAT_ID_1, CHAT_ID_2):
+        if not chat_id:
+            continue
+        try:
+            me = await bot.get_chat_member(chat_id=chat_id, user_id=bot.id)
+            if me.status not in BOT_ADMIN_STATUSES:
+                logger.warning(f"Бот не админ в чате {chat_id}, участие проверяется только через API")
+                continue
+            admins = await bot.get_chat_administrators(chat_id)
+        except Exception as e:
+            logger.warning(f"Не удалось получить админов чата {chat_id}: {e}")
+            continue
+        set_bot_admin(chat_id, True)
+        for admin in admins:
+            set_member(chat_id, admin.user.id, True)
+
+def sweep_membership_cache(ttl: int = MEMBERSHIP_TTL):
+    """Удаляет устаревшие записи, чтобы кэш не рос бесконечно"""
+    now = time.time()
+    expired = [key for key, (ts, _) in MEMBERSHIP_CACHE.items() if now - ts >= ttl]
+    for key in expired:
+        del MEMBERSHIP_CACHE[key]
+
+async def calculate_limit(user_id: int, user_data: UserRec) -> int:
     """
     Считает лимит. Приоритет: 
     1. Ручной лимит админа (если установлен).
     2. Сумма бонусов за чаты.
     """
     # Если админ установил жесткий лимит
-    if user_data.get("manual_limit") is not None:
-        return user_data["manual_limit"]
+    if user_data.manual_limit is not None:
+        return user_data.manual_limit
+
+    # Проверяем оба чата параллельно, а не по очереди
+    chats = [(num, chat_id) for num, chat_id in ((1, CHAT_ID_1), (2, CHAT_ID_2)) if chat_id]
+    results = await asyncio.gather(
+        *(is_chat_member(chat_id, user_id) for _, chat_id in chats),
+        return_exceptions=True
+    )
 
     limit = 0
-    # Проверка чата 1
-    if CHAT_ID_1:
-        try:
-            member = await bot.get_chat_member(chat_id=CHAT_ID_1, user_id=user_id)
-            if member.status in ['member', 'administrator', 'creator']:
-                limit += KEYS_PER_CHAT
-        except Exception as e:
-            logger.warning(f"Ошибка проверки чата 1 для {user_id}: {e}")
-
-    # Проверка чата 2
-    if CHAT_ID_2:
-        try:
-            member = await bot.get_chat_member(chat_id=CHAT_ID_2, user_id=user_id)
-            if member.status in ['member', 'administrator', 'creator']:
-                limit += KEYS_PER_CHAT
-        except Exception as e:
-            logger.warning(f"Ошибка проверки чата 2 для {user_id}: {e}")
+    for (num, _), is_member in zip(chats, results):
+        if isinstance(is_member, Exception):
+            logger.warning(f"Ошибка проверки чата {num} для {user_id}: {is_member}")
+        elif is_member:
+            limit += KEYS_PER_CHAT
     
     # Базовый лимит, если не в чатах (например, 1 пробный)
     if limit == 0:
@@ -102,44 +383,173 @@ async def calculate_limit(user_id: int, user_data: Dict) -> int:
         
     return limit
 
+def prune_expired_keys(user_data: UserRec, now: float) -> bool:
+    """Убирает истёкшие ключи пользователя, возвращает True если что-то удалено"""
+    active_keys = [k for k in user_data.keys if k["valid_until"] > now]
+    if len(active_keys) == len(user_data.keys):
+        return False
+    user_data.keys = active_keys
+    user_data.keys_used = len(active_keys)
+    return True
+
+def sweep_expired_keys(data: Dict):
+    """Чистит истёкшие ключи у всех пользователей"""
+    now = time.time()
+    for uid, user_data in data["users"].items():
+        if prune_expired_keys(user_data, now):
+            mark_dirty(uid)
+
+# Запас случайных байт, чтобы не ходить в os.urandom на каждый ключ
+RAND_POOL_SIZE = 4096
+RAND_POOL = bytearray()
+RAND_IDX = 0
+
+def refill_rand_pool(force: bool = False):
+    """Пополняет пул, если израсходовано больше половины"""
+    global RAND_POOL, RAND_IDX
+    if force or RAND_IDX > len(RAND_POOL) // 2:
+        RAND_POOL = bytearray(secrets.token_bytes(RAND_POOL_SIZE))
+        RAND_IDX = 0
+
+def get_random_hex(nbytes: int) -> str:
+    """Аналог secrets.token_hex, но берёт байты из пула (каждый байт используется один раз)"""
+    global RAND_IDX
+    if RAND_IDX + nbytes > len(RAND_POOL):
+        refill_rand_pool(force=True)
+    chunk = RAND_POOL[RAND_IDX:RAND_IDX + nbytes]
+    RAND_IDX += nbytes
+    return chunk.hex()
+
 def generate_key_string() -> str:
     """Генерирует случайный ключ"""
-    return f"KVN-{secrets.token_hex(4).upper()}"
+    return f"KVN-{get_random_hex(4).upper()}"
+
+# --- ОГРАНИЧЕНИЕ СКОРОСТИ ---
+
+class RateLimiter:
+    """Token bucket: rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # Под локом ждущие обслуживаются по очереди
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return not self.lock.locked() and self.tokens >= self.capacity
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Придерживает апдейты, чтобы ответы не упирались в 429 от Telegram"""
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE):
+        self.global_limiter = RateLimiter(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_limiters: Dict[int, RateLimiter] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        chat = data.get("event_chat") or data.get("event_from_user")
+        if chat is not None:
+            limiter = self.chat_limiters.get(chat.id)
+            if limiter is None:
+                limiter = self.chat_limiters[chat.id] = RateLimiter(self.chat_rate, self.chat_rate)
+            await limiter.acquire()
+        await self.global_limiter.acquire()
+        return await handler(event, data)
+
+    def sweep(self):
+        """Удаляет корзины чатов, которые давно ничего не отправляли"""
+        idle = [chat_id for chat_id, limiter in self.chat_limiters.items() if limiter.is_idle()]
+        for chat_id in idle:
+            del self.chat_limiters[chat_id]
+
+throttling = ThrottlingMiddleware()
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
 
 # --- МАШИНА СОСТОЯНИЙ (FSM) ДЛЯ АДМИНА ---
 class AdminState(StatesGroup):
     waiting_for_user_input = State()
 
+# --- CALLBACK DATA ---
+
+class HelpSection(CallbackData, prefix="help"):
+    section: str
+
+class SetLimit(CallbackData, prefix="set_lim"):
+    user_id: str
+    limit: int
+
+class CheckPay(CallbackData, prefix="check_pay"):
+    comment: str
+
 # --- КЛАВИАТУРЫ ---
 
+# Статичные клавиатуры собираем один раз при импорте
+_MAIN_MENU_BUTTONS = [
+    [KeyboardButton(text="🛒 Купить КВН"), KeyboardButton(text="🎁 Получить ключ")],
+    [KeyboardButton(text="📖 Мои КВН"), KeyboardButton(text="ℹ️ Помощь")]
+]
+MAIN_MENU_USER = ReplyKeyboardMarkup(keyboard=_MAIN_MENU_BUTTONS, resize_keyboard=True)
+MAIN_MENU_ADMIN = ReplyKeyboardMarkup(
+    keyboard=_MAIN_MENU_BUTTONS + [[KeyboardButton(text="⚙️ Админ-панель")]],
+    resize_keyboard=True
+)
+
+HELP_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📄 Инструкция", callback_data=HelpSection(section="instr").pack()),
+     InlineKeyboardButton(text="🌐 Локации серверов", callback_data=HelpSection(section="loc").pack())],
+    [InlineKeyboardButton(text="⚡ Обход отключений", callback_data=HelpSection(section="bypass").pack()),
+     InlineKeyboardButton(text="🔌 Подключение v2Ray", callback_data=HelpSection(section="v2ray").pack())],
+    [InlineKeyboardButton(text="🛠 Решение проблем", callback_data=HelpSection(section="trouble").pack()),
+     InlineKeyboardButton(text="💡 Полезные фичи", callback_data=HelpSection(section="features").pack())],
+    [InlineKeyboardButton(text="⬅ Назад", callback_data=HelpSection(section="back").pack())] # Просто скрывает сообщение
+])
+
+HELP_TEXTS = {
+    "instr": "📄 <b>Инструкция:</b>\n1. Скачайте клиент V2Ray.\n2. Скопируйте ключ.\n3. Импортируйте из буфера обмена.\n4. Нажмите Connect.",
+    "loc": "🌐 <b>Локации:</b>\n- Германия 🇩🇪\n- Нидерланды 🇳🇱\n- США 🇺🇸",
+    "bypass": "⚡ <b>Обход блокировок:</b>\nМы используем протоколы VLESS + Reality для максимальной скрытности.",
+    "v2ray": "🔌 <b>Подключение:</b>\nСкачайте приложение:\n- Android: v2rayNG\n- iOS: FoXray / Shadowrocket\n- PC: v2rayN",
+    "trouble": "🛠 <b>Решение проблем:</b>\nЕсли не подключается, проверьте синхронизацию времени на устройстве.",
+    "features": "💡 <b>Фичи:</b>\n- Высокая скорость\n- Безлимитный трафик\n- Поддержка UDP",
+}
+
+# Тексты помощи по готовой callback_data: раздел находится одним поиском в dict
+HELP_BY_DATA = {HelpSection(section=section).pack(): text for section, text in HELP_TEXTS.items()}
+
+# Варианты для быстрой установки лимита в админке
+ADMIN_LIMITS = (1, 8, 16, 100)
+
 def get_main_menu(is_admin: bool = False):
-    buttons = [
-        [KeyboardButton(text="🛒 Купить КВН"), KeyboardButton(text="🎁 Получить ключ")],
-        [KeyboardButton(text="📖 Мои КВН"), KeyboardButton(text="ℹ️ Помощь")]
-    ]
-    if is_admin:
-        buttons.append([KeyboardButton(text="⚙️ Админ-панель")])
-    return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
-
-def get_help_keyboard():
-    buttons = [
-        [InlineKeyboardButton(text="📄 Инструкция", callback_data="help_instr"),
-         InlineKeyboardButton(text="🌐 Локации серверов", callback_data="help_loc")],
-        [InlineKeyboardButton(text="⚡ Обход отключений", callback_data="help_bypass"),
-         InlineKeyboardButton(text="🔌 Подключение v2Ray", callback_data="help_v2ray")],
-        [InlineKeyboardButton(text="🛠 Решение проблем", callback_data="help_trouble"),
-         InlineKeyboardButton(text="💡 Полезные фичи", callback_data="help_features")],
-        [InlineKeyboardButton(text="⬅ Назад", callback_data="help_back")] # Просто скрывает сообщение
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return MAIN_MENU_ADMIN if is_admin else MAIN_MENU_USER
 
 def get_admin_limits_keyboard(target_user_id: str):
     # Кнопки для быстрой установки лимита
-    limits = [1, 8, 16, 100]
     buttons = []
     row = []
-    for lim in limits:
-        row.append(InlineKeyboardButton(text=str(lim), callback_data=f"set_lim_{target_user_id}_{lim}"))
+    for lim in ADMIN_LIMITS:
+        row.append(InlineKeyboardButton(text=str(lim), callback_data=SetLimit(user_id=target_user_id, limit=lim).pack()))
     buttons.append(row)
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
@@ -148,9 +558,8 @@ def get_admin_limits_keyboard(target_user_id: str):
 @dp.message(Command("start"))
 async def start_cmd(message: types.Message):
     user_id = str(message.from_user.id)
-    data = load_data()
+    data = DATA
     ensure_user(user_id, message.from_user.username, data)
-    save_data(data)
     
     is_admin = message.from_user.id in ADMINS
     await message.answer(
@@ -168,14 +577,18 @@ async def back_to_menu(message: types.Message):
 @dp.message(F.text == "🎁 Получить ключ")
 async def get_key_handler(message: types.Message):
     user_id_str = str(message.from_user.id)
-    data = load_data()
+    data = DATA
     ensure_user(user_id_str, message.from_user.username, data)
     
     # 1. Считаем текущий лимит (асинхронно, т.к. запросы к API телеграм)
     limit = await calculate_limit(message.from_user.id, data["users"][user_id_str])
     
     user_record = data["users"][user_id_str]
-    used = len(user_record["keys"]) # Фактическое количество активных ключей
+    now = time.time()
+    # Истёкшие ключи не занимают слот
+    if prune_expired_keys(user_record, now):
+        mark_dirty(user_id_str)
+    used = len(user_record.keys) # Фактическое количество активных ключей
     
     # 2. Проверяем лимит
     if used >= limit:
@@ -190,90 +603,71 @@ async def get_key_handler(message: types.Message):
 
     # 3. Генерируем ключ
     new_key_value = generate_key_string()
-    expiration_date = datetime.now() + timedelta(days=30)
+    valid_until = int(now) + KEY_TTL
     
     key_obj = {
-        "id": secrets.token_hex(3).upper(),
+        "id": get_random_hex(3).upper(),
         "key": new_key_value,
-        "valid_until": expiration_date.timestamp(),
-        "created_at": datetime.now().timestamp()
+        "valid_until": valid_until,
+        "created_at": int(now)
     }
     
     # 4. Сохраняем
-    user_record["keys"].append(key_obj)
-    user_record["keys_used"] = len(user_record["keys"]) # Обновляем счетчик
-    save_data(data)
+    user_record.keys.append(key_obj)
+    user_record.keys_used = len(user_record.keys) # Обновляем счетчик
+    mark_dirty(user_id_str)
     
     # 5. Отправляем
     await message.answer(
         f"✅ <b>Ключ успешно выдан!</b>\n\n"
         f"🔑 <code>{new_key_value}</code>\n"
-        f"📅 Годен до: {expiration_date.strftime('%d.%m.%Y')}\n\n"
-        f"📊 Прогресс: получен ключ {len(user_record['keys'])}/{limit}",
+        f"📅 Годен до: {time.strftime('%d.%m.%Y', time.localtime(valid_until))}\n\n"
+        f"📊 Прогресс: получен ключ {len(user_record.keys)}/{limit}",
         parse_mode="HTML"
     )
 
 @dp.message(F.text == "📖 Мои КВН")
 async def my_keys_handler(message: types.Message):
     user_id_str = str(message.from_user.id)
-    data = load_data()
+    data = DATA
     ensure_user(user_id_str, message.from_user.username, data)
     
-    keys = data["users"][user_id_str]["keys"]
+    keys = data["users"][user_id_str].keys
     
     if not keys:
         await message.answer("📂 У вас пока нет активных ключей.")
         return
         
-    response = "<b>📂 Ваши ключи:</b>\n\n"
-    current_time = datetime.now().timestamp()
-    
-    # Фильтрация истекших ключей (опционально можно удалять их)
-    active_keys = []
+    parts = ["<b>📂 Ваши ключи:</b>", ""]
+    current_time = time.time()
     
+    # Истёкшие ключи удаляются при выдаче нового и раз в сутки в background_worker
     for k in keys:
         if k["valid_until"] > current_time:
-            date_str = datetime.fromtimestamp(k["valid_until"]).strftime('%d.%m.%Y')
-            response += f"🔑 <code>{k['key']}</code> (до {date_str})\n"
-            active_keys.append(k)
+            date_str = time.strftime('%d.%m.%Y', time.localtime(k["valid_until"]))
+            parts.append(f"🔑 <code>{k['key']}</code> (до {date_str})")
         else:
             # Ключ истек
-            response += f"❌ <s>{k['key']}</s> (Истёк)\n"
-    
-    # Обновляем JSON, убирая старые ключи (если нужно, раскомментируй)
-    # data["users"][user_id_str]["keys"] = active_keys
-    # save_data(data)
+            parts.append(f"❌ <s>{k['key']}</s> (Истёк)")
             
-    await message.answer(response, parse_mode="HTML")
+    await message.answer("\n".join(parts), parse_mode="HTML")
 
 # --- ХЕНДЛЕРЫ: ПОМОЩЬ ---
 
 @dp.message(F.text == "ℹ️ Помощь")
 async def help_menu_handler(message: types.Message):
-    await message.answer("📚 Выберите раздел помощи:", reply_markup=get_help_keyboard())
+    await message.answer("📚 Выберите раздел помощи:", reply_markup=HELP_KB)
 
-@dp.callback_query(F.data.startswith("help_"))
-async def help_callback_handler(callback: types.CallbackQuery):
-    action = callback.data.split("_")[1]
-    
-    texts = {
-        "instr": "📄 <b>Инструкция:</b>\n1. Скачайте клиент V2Ray.\n2. Скопируйте ключ.\n3. Импортируйте из буфера обмена.\n4. Нажмите Connect.",
-        "loc": "🌐 <b>Локации:</b>\n- Германия 🇩🇪\n- Нидерланды 🇳🇱\n- США 🇺🇸",
-        "bypass": "⚡ <b>Обход блокировок:</b>\nМы используем протоколы VLESS + Reality для максимальной скрытности.",
-        "v2ray": "🔌 <b>Подключение:</b>\nСкачайте приложение:\n- Android: v2rayNG\n- iOS: FoXray / Shadowrocket\n- PC: v2rayN",
-        "trouble": "🛠 <b>Решение проблем:</b>\nЕсли не подключается, проверьте синхронизацию времени на устройстве.",
-        "features": "💡 <b>Фичи:</b>\n- Высокая скорость\n- Безлимитный трафик\n- Поддержка UDP",
-    }
-    
-    if action == "back":
-        await callback.message.delete()
-        return
-
-    text = texts.get(action, "Информация отсутствует.")
+@dp.callback_query(F.data.in_(HELP_BY_DATA))
+async def help_section_handler(callback: types.CallbackQuery):
     # Редактируем сообщение, оставляя клавиатуру
-    await callback.message.edit_text(text, reply_markup=get_help_keyboard(), parse_mode="HTML")
+    await callback.message.edit_text(HELP_BY_DATA[callback.data], reply_markup=HELP_KB, parse_mode="HTML")
     await callback.answer()
 
+@dp.callback_query(F.data == HelpSection(section="back").pack())
+async def help_back_handler(callback: types.CallbackQuery):
+    await callback.message.delete()
+
 # --- ХЕНДЛЕРЫ: АДМИН ПАНЕЛЬ ---
 
 @dp.message(F.text == "⚙️ Админ-панель")
@@ -294,18 +688,14 @@ async def admin_user_search(message: types.Message, state: FSMContext):
         return
 
     query = message.text.strip()
-    data = load_data()
+    data = DATA
     target_id = None
     
     # Поиск по ID или Username
     if query.isdigit():
         target_id = query
     elif query.startswith("@"):
-        uname = query[1:]
-        for uid, udata in data["users"].items():
-            if udata.get("username") == uname:
-                target_id = uid
-                break
+        target_id = USERNAME_INDEX.get(query[1:])
     
     if not target_id or target_id not in data["users"]:
         await message.answer("❌ Пользователь не найден в базе (он должен хоть раз запустить бота). Попробуйте снова.")
@@ -315,10 +705,10 @@ async def admin_user_search(message: types.Message, state: FSMContext):
     await state.update_data(target_user_id=target_id)
     
     user_info = data["users"][target_id]
-    current_lim = user_info.get("manual_limit", "Авто (по чатам)")
+    current_lim = user_info.manual_limit if user_info.manual_limit is not None else "Авто (по чатам)"
     
     await message.answer(
-        f"👤 Пользователь найден: <code>{target_id}</code> (@{user_info.get('username')})\n"
+        f"👤 Пользователь найден: <code>{target_id}</code> (@{user_info.username})\n"
         f"Текущий лимит: {current_lim}\n\n"
         f"Выберите новый лимит:",
         reply_markup=get_admin_limits_keyboard(target_id),
@@ -326,34 +716,48 @@ async def admin_user_search(message: types.Message, state: FSMContext):
     )
     await state.clear() # Сбрасываем состояние, так как дальше работаем через инлайн кнопки
 
-@dp.callback_query(F.data.startswith("set_lim_"))
-async def set_limit_callback(callback: types.CallbackQuery):
+@dp.callback_query(SetLimit.filter())
+async def set_limit_callback(callback: types.CallbackQuery, callback_data: SetLimit):
     if callback.from_user.id not in ADMINS:
         await callback.answer("Нет прав.", show_alert=True)
         return
 
-    _, target_id, limit_val = callback.data.split("_")
-    new_limit = int(limit_val)
+    target_id = callback_data.user_id
+    new_limit = callback_data.limit
     
-    data = load_data()
+    data = DATA
     if target_id in data["users"]:
-        data["users"][target_id]["manual_limit"] = new_limit
-        save_data(data)
+        data["users"][target_id].manual_limit = new_limit
+        mark_dirty(target_id)
         
         await callback.message.edit_text(
             f"✅ Лимит для пользователя <code>{target_id}</code> установлен на <b>{new_limit}</b>.",
             parse_mode="HTML"
         )
         
-        # Оповещение пользователю (опционально)
-        try:
-            await bot.send_message(target_id, f"🎉 Ваш лимит ключей обновлен! Теперь доступно: {new_limit}")
-        except:
-            pass
+        # Оповещение пользователю (опционально), не ждём отправки
+        spawn(bot.send_message(target_id, f"🎉 Ваш лимит ключей обновлен! Теперь доступно: {new_limit}"))
             
     else:
         await callback.answer("Ошибка: пользователь не найден.", show_alert=True)
 
+# --- ХЕНДЛЕРЫ: УЧАСТНИКИ ЧАТОВ ---
+
+# Telegram присылает chat_member, только если бот — админ в чате
+@dp.chat_member(F.chat.id.in_({CHAT_ID_1, CHAT_ID_2} - {0}))
+async def chat_member_handler(event: types.ChatMemberUpdated):
+    chat_id = event.chat.id
+    user_id = event.new_chat_member.user.id
+    status = event.new_chat_member.status
+    MEMBERSHIP_CACHE[(chat_id, user_id)] = (time.time(), status)
+    if chat_id in ADMIN_CHATS:
+        set_member(chat_id, user_id, status in MEMBER_STATUSES)
+
+# Права самого бота в чате: от них зависит, приходят ли chat_member апдейты
+@dp.my_chat_member(F.chat.id.in_({CHAT_ID_1, CHAT_ID_2} - {0}))
+async def bot_chat_member_handler(event: types.ChatMemberUpdated):
+    set_bot_admin(event.chat.id, event.new_chat_member.status in BOT_ADMIN_STATUSES)
+
 # --- TON ПЛАТЕЖИ (ЗАГЛУШКА) ---
 
 @dp.message(F.text == "🛒 Купить КВН")
@@ -366,18 +770,18 @@ async def buy_key_handler(message: types.Message):
     link = f"ton://transfer/{WALLET_ADDRESS}?amount={int(amount_ton*1e9)}&text={comment}"
     
     # Сохраняем в pending
-    data = load_data()
+    data = DATA
     data["pending"][comment] = {
         "user_id": str(message.from_user.id),
         "amount": amount_ton,
         "created_at": time.time(),
         "status": "waiting"
     }
-    save_data(data)
+    mark_dirty(comment=comment)
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💸 Оплатить", url=link)],
-        [InlineKeyboardButton(text="🔄 Проверить оплату", callback_data=f"check_pay_{comment}")]
+        [InlineKeyboardButton(text="🔄 Проверить оплату", callback_data=CheckPay(comment=comment).pack())]
     ])
     
     await message.answer(
@@ -388,9 +792,9 @@ async def buy_key_handler(message: types.Message):
         parse_mode="HTML"
     )
 
-@dp.callback_query(F.data.startswith("check_pay_"))
-async def check_payment_manual(callback: types.CallbackQuery):
-    comment = callback.data.replace("check_pay_", "")
+@dp.callback_query(CheckPay.filter())
+async def check_payment_manual(callback: types.CallbackQuery, callback_data: CheckPay):
+    comment = callback_data.comment
     # В реальном боте здесь запрос к TON API
     # Сделаем эмуляцию для примера:
     
@@ -401,56 +805,182 @@ async def check_payment_manual(callback: types.CallbackQuery):
     else:
         await callback.answer("❌ Оплата еще не поступила. Попробуйте через минуту.", show_alert=True)
 
+# Кнопки, отправленные до перехода на CallbackData, несут старый формат "check_pay_<comment>"
+@dp.callback_query(F.data.startswith("check_pay_"))
+async def check_payment_legacy(callback: types.CallbackQuery):
+    comment = callback.data[len("check_pay_"):]
+    await check_payment_manual(callback, CheckPay(comment=comment))
+
+# Старые кнопки помощи и админки просто просим запросить заново
+@dp.callback_query(F.data.startswith(("help_", "set_lim_")))
+async def legacy_callback_handler(callback: types.CallbackQuery):
+    await callback.answer("⚠️ Кнопка устарела, запросите меню заново.", show_alert=True)
+
 async def finalize_payment(comment_id: str, message: types.Message = None):
-    data = load_data()
+    data = DATA
     if comment_id in data["pending"]:
         info = data["pending"][comment_id]
         user_id = info["user_id"]
         
         # Выдача награды: Увеличиваем лимит на +1
         if user_id in data["users"]:
-            current_manual = data["users"][user_id].get("manual_limit")
+            current_manual = data["users"][user_id].manual_limit
             if current_manual is None:
                 current_manual = await calculate_limit(int(user_id), data["users"][user_id])
             
-            data["users"][user_id]["manual_limit"] = current_manual + 1
+            data["users"][user_id].manual_limit = current_manual + 1
             del data["pending"][comment_id]
-            save_data(data)
+            mark_dirty(user_id, comment_id)
             
-            msg = f"✅ Оплата прошла! Ваш лимит увеличен до {data['users'][user_id]['manual_limit']}."
+            msg = f"✅ Оплата прошла! Ваш лимит увеличен до {data['users'][user_id].manual_limit}."
             if message:
                 await message.edit_text(msg)
             else:
-                await bot.send_message(user_id, msg)
+                spawn(bot.send_message(user_id, msg))
+
+async def fetch_incoming_payments(client: httpx.AsyncClient) -> Dict[str, int]:
+    """Последние входящие переводы на кошелёк: комментарий -> сумма в нанотонах"""
+    resp = await client.get(
+        f"{TONAPI_URL}/blockchain/accounts/{WALLET_ADDRESS}/transactions",
+        params={"limit": TON_TX_LIMIT},
+        headers={"Authorization": f"Bearer {TONAPI_KEY}"} if TONAPI_KEY else None
+    )
+    resp.raise_for_status()
+
+    payments: Dict[str, int] = {}
+    for tx in orjson.loads(resp.content)["transactions"]:
+        in_msg = tx.get("in_msg") or {}
+        comment = (in_msg.get("decoded_body") or {}).get("text")
+        if comment:
+            payments[comment] = payments.get(comment, 0) + in_msg.get("value", 0)
+    return payments
+
+async def check_all_pending(client: httpx.AsyncClient):
+    """Сверяет все ожидающие оплаты с одной выборкой транзакций вместо запроса на каждую"""
+    waiting = [comment for comment, info in DATA["pending"].items() if info["status"] == "waiting"]
+    if not waiting or not WALLET_ADDRESS:
+        return
+
+    payments = await fetch_incoming_payments(client)
+    for comment in waiting:
+        info = DATA["pending"].get(comment)
+        paid = payments.get(comment)
+        if info is not None and paid is not None and paid >= info["amount"] * 1e9:
+            await finalize_payment(comment)
+
+    # Истекаем счета только после успешной сверки: при сбое TON API
+    # оплаченный, но ещё не увиденный счёт не должен пропасть
+    expire_stale_pending()
+
+def expire_stale_pending():
+    """Помечает истёкшими счета, которые так и не оплатили за PENDING_TTL"""
+    now = time.time()
+    for comment, info in DATA["pending"].items():
+        if info["status"] != "waiting" or now - info["created_at"] < PENDING_TTL:
+            continue
+        # Запись остаётся в базе, чтобы оплату можно было сверить вручную
+        info["status"] = "expired"
+        mark_dirty(comment=comment)
+        spawn(bot.send_message(
+            info["user_id"],
+            "⌛ Срок оплаты счёта истёк. Если вы уже оплатили, напишите администратору, "
+            "иначе создайте новый счёт через «🛒 Купить КВН»."
+        ))
 
 # --- ФОНОВЫЕ ПРОЦЕССЫ ---
 
+HTTPX: Optional[httpx.AsyncClient] = None
+
+def create_http_client() -> httpx.AsyncClient:
+    """Один клиент на весь процесс: keep-alive, HTTP/2 и повтор при сбое соединения"""
+    # При явном transport настройки http2/limits берутся из него, а не из клиента
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+        retries=HTTP_RETRIES
+    )
+    return httpx.AsyncClient(transport=transport, timeout=HTTP_TIMEOUT)
+
 async def background_worker():
     """Фоновая задача для проверки платежей (long polling или cron)"""
+    last_keys_sweep = 0.0
     while True:
+        # Сбой TON API не должен останавливать остальную уборку
+        try:
+            await check_all_pending(HTTPX)
+        except Exception as e:
+            logger.warning(f"Ошибка проверки платежей: {e}")
+
         try:
-            # Здесь логика проверки TON API для всех записей в data['pending']
-            # await check_all_pending_transactions()
-            await asyncio.sleep(60) # Проверка раз в минуту
+            sweep_membership_cache()
+            throttling.sweep()
+            refill_rand_pool()
+            if time.time() - last_keys_sweep >= KEYS_SWEEP_INTERVAL:
+                sweep_expired_keys(DATA)
+                last_keys_sweep = time.time()
         except Exception as e:
             logger.error(f"Background worker error: {e}")
-            await asyncio.sleep(60)
+
+        await asyncio.sleep(60) # Проверка раз в минуту
 
 # --- ЗАПУСК ---
 
 async def main():
-    # Запуск фоновой задачи
-    asyncio.create_task(background_worker())
-    
+    global HTTPX
+    await init_db()
+    # Всё, что после открытия базы, — внутри try: поток aiosqlite не daemon,
+    # и без DB.close() процесс повиснет вместо падения
     try:
-        # Удаляем вебхук и запускаем поллинг
-        await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
-    except Exception as e:
-        logger.error(f"Error starting bot: {e}")
+        # Загружаем базу один раз при старте
+        DATA.update(await load_data())
+        if not DATA["users"] and not DATA["pending"]:
+            # Первый запуск после перехода на SQLite: переносим data.json
+            legacy = await load_json_data()
+            DATA["users"] = {uid: UserRec.from_dict(user) for uid, user in legacy["users"].items()}
+            DATA["pending"] = legacy["pending"]
+            for uid in DATA["users"]:
+                mark_dirty(uid)
+            for comment in DATA["pending"]:
+                mark_dirty(comment=comment)
+        build_username_index(DATA)
+
+        HTTPX = create_http_client()
+        try:
+            # Запуск фоновых задач
+            spawn(background_worker())
+            flusher_task = spawn(flusher())
+            
+            try:
+                # Прогреваем соединение, удаляем вебхук и запускаем поллинг
+                await bot.get_me()
+                await bot.delete_webhook(drop_pending_updates=True)
+                await bootstrap_members()
+                # chat_member не приходит по умолчанию, его нужно запросить явно
+                await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+            except Exception as e:
+                logger.error(f"Error starting bot: {e}")
+            finally:
+                try:
+                    # Останавливаем flusher, чтобы он не писал параллельно с финальным сбросом
+                    flusher_task.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await flusher_task
+                    # Сбрасываем несохранённые изменения перед выходом
+                    if DATA_DIRTY.is_set():
+                        await flush_dirty()
+                except Exception as e:
+                    logger.error(f"Ошибка сохранения базы при остановке: {e}")
+        finally:
+            await HTTPX.aclose()
+    finally:
+        await DB.close()
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot stopped!")
+    finally:
+        log_listener.stop()